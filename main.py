@@ -12,38 +12,82 @@ The policy must be in the current working directory
 """
 
 import json
+import os
 import sys
-from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from rich.console import Console
 from rich.markdown import Markdown
-api_key =""
-client = OpenAI(api_key=api_key)
+
+_client = None
+
+def _get_client():
+    # Lazy: importing the SDK and opening a connection pool only happens
+    # when we actually talk to the API, so crawl_directory stays usable as
+    # a library. The key comes from the environment, never from source.
+    global _client
+    if _client is None:
+        from openai import OpenAI
+        _client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+    return _client
+
+def _read_head(file_path):
+    try:
+        with open(file_path, 'rb') as f:
+            head = f.read(512)  # bounded read, not the whole file
+        if b'\0' in head:  # cheap binary sniff
+            return None
+        return head.decode('utf-8', 'ignore')[:500]
+    except Exception:
+        return None
 
 def crawl_directory(path: Path, max_file_size=10_000):
     structure = []
-    for file_path in path.rglob('*'):
-        if file_path.is_file():
-            entry = {
-                "path": str(file_path.relative_to(path)),
-                "size": file_path.stat().st_size,
-                "content": None,
-            }
-            if entry["size"] < max_file_size:
-                try:
-                    entry["content"] = file_path.read_text(errors='ignore')[:500]  # First 500 chars
-                except Exception:
-                    pass
-            structure.append(entry)
+    previews = []  # (index into structure, absolute path) of files to preview
+    # scandir walk: the DirEntry already knows whether it is a file, so no
+    # extra stat syscall per entry like rglob + is_file()
+    stack = [(str(path), "")]
+    while stack:
+        dir_path, prefix = stack.pop()
+        try:
+            it = os.scandir(dir_path)
+        except OSError:
+            continue
+        with it:
+            for dir_entry in it:
+                if dir_entry.is_dir(follow_symlinks=False):
+                    stack.append((dir_entry.path, f"{prefix}{dir_entry.name}/"))
+                    continue
+                if not dir_entry.is_file(follow_symlinks=False):
+                    continue
+                entry = {
+                    "path": f"{prefix}{dir_entry.name}",
+                    "size": dir_entry.stat().st_size,
+                    "content": None,
+                }
+                if entry["size"] < max_file_size:
+                    previews.append((len(structure), dir_entry.path))
+                structure.append(entry)
+    # The preview reads are independent I/O waits, so overlap them in a
+    # thread pool; for a handful of files the pool isn't worth its startup
+    if len(previews) < 16:
+        for index, file_path in previews:
+            structure[index]["content"] = _read_head(file_path)
+    else:
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            paths = [file_path for _, file_path in previews]
+            for (index, _), content in zip(previews, pool.map(_read_head, paths, chunksize=16)):
+                structure[index]["content"] = content
     return structure
 
 def load_policy_document(policy_path: Path):
-    return policy_path.read_text()
+    return policy_path.read_text(encoding='utf-8', errors='ignore')
 
-def ask_chatgpt(structure, policy):
-    system_prompt = """
+SYSTEM_PROMPT = """
 You are an expert project steward whose job is to keep every code or data repository in a clean, transparent, and reproducible state. Whenever a user asks you to create, rename, reorganise, or review files and folders, apply the following policy strictly and proactively. Never apologise for enforcing these rules—simply explain the required change and show the corrected structure.
 """
+
+def ask_chatgpt(structure, policy):
     user_prompt = f"""Policy:
 {policy}
 
@@ -51,10 +95,10 @@ Folder Structure and Files:
 {structure}
 """
 
-    response = client.chat.completions.create(
+    response = _get_client().chat.completions.create(
         model="gpt-4o",
         messages=[
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": user_prompt}
         ],
         temperature=0.2
@@ -68,13 +112,14 @@ if __name__ == "__main__":
         print("The folder you provided does not exist!!")
         sys.exit()
     
-    structure = json.dumps(crawl_directory(path),indent=2)
+    # compact separators: cheaper to serialize and far fewer prompt tokens
+    structure = json.dumps(crawl_directory(path), separators=(',', ':'))
     policy_file = Path("policy.txt")
     if not policy_file.exists():
         print("The policy file is missing!")
         sys.exit()
     
-    policy = policy_file.read_text()
+    policy = load_policy_document(policy_file)
 
     answer = ask_chatgpt(structure, policy)
     console = Console()
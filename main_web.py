@@ -12,16 +12,25 @@ The policy must be in the current working directory
 """
 from __future__ import annotations
 
+import asyncio
+import hashlib
+import io
 import json
 import os
 import re
-import subprocess
+import shutil
 import sys
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
 from pathlib import Path
 from typing import Any, Dict, List
 
 import streamlit as st
-from openai import OpenAI
 
 # ────────────────────────────────────────────────────────────────────────────────
 # Native folder dialog (desktop only – never on Linux)
@@ -33,6 +42,7 @@ except Exception:
     _tk = None  # falls back automatically
 
 
+@cache
 def _dialog_supported() -> bool:
     """Return True if we *should* try to open the Tk dialog."""
     if _tk is None:
@@ -59,31 +69,459 @@ def _open_directory_dialog() -> str | None:
 # Helpers (mirroring CLI behaviour)
 # ────────────────────────────────────────────────────────────────────────────────
 
+@cache
+def _openai_cls():
+    """Import the OpenAI SDK on first use (heavy transitive tree: httpx,
+    pydantic, ...) so merely importing this module stays cheap."""
+    from openai import OpenAI
+
+    return OpenAI
+
+
+def _prewarm_imports() -> None:
+    """Pre-warm the SDK import in the background so it overlaps with the
+    user typing a path / uploading a zip instead of stalling the first
+    validation. Only worthwhile (and safe) in a long-lived app process —
+    a daemon thread importing during a short-lived script's shutdown can
+    crash the interpreter."""
+    threading.Thread(target=_openai_cls, daemon=True).start()
+
+
+_LOOP: asyncio.AbstractEventLoop | None = None
+_LOOP_LOCK = threading.Lock()
+
+
+def _run_async(coro):
+    """Run *coro* on a persistent background event loop.
+
+    ``asyncio.run`` would build and tear down a fresh loop (plus DNS/SSL
+    state) on every Streamlit rerun; one long-lived daemon loop amortizes
+    that setup and keeps warm connections alive across calls.
+    """
+    global _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            _LOOP = asyncio.new_event_loop()
+            threading.Thread(
+                target=_LOOP.run_forever, name="steward-loop", daemon=True
+            ).start()
+    return asyncio.run_coroutine_threadsafe(coro, _LOOP).result()
+
+
+_SYSTEM_PROMPT = (
+    """
+You are an expert project steward whose job is to keep every code or data repository in a clean, transparent, and reproducible state. Whenever a user asks you to create, rename, reorganise, or review files and folders, apply the following policy strictly and proactively. Never apologise for enforcing these rules—simply explain the required change and show the corrected structure.
+    """
+).strip()
+
+
+# Directory noise that never belongs in a structure review.
+_SKIP_DIRS = {"venv", ".venv", ".git", "node_modules", "__pycache__"}
+
+# Async file I/O is optional; without it the thread-pool crawl is used.
+try:
+    import aiofiles
+except ImportError:
+    aiofiles = None
+
+
+# Extensions that are never worth opening for a text preview.
+_BINARY_EXTS = {
+    ".png", ".jpg", ".jpeg", ".gif", ".bmp", ".ico", ".pdf",
+    ".zip", ".gz", ".tar", ".7z", ".whl", ".exe", ".dll", ".so", ".dylib",
+    ".sqlite", ".db", ".pkl", ".pickle", ".parquet", ".npy", ".npz",
+}
+
+
+# Strip C0 control characters from previews; whitespace is collapsed
+# separately so none of it needs preserving here.
+_CTRL_TBL = dict.fromkeys(range(32))
+
+
+def _truncate_snippet(buf: bytes) -> str | None:
+    """Decode a preview head and keep at most two lines / 512 chars."""
+    if b"\0" in buf:  # classic binary sniff for unknown extensions
+        return None
+    # A hard slice plus maxsplit bounds the work to the part we keep; at
+    # 512 chars the old word-count pass couldn't matter for token budgets.
+    text = buf.decode("utf-8", "ignore")[:512]
+    snippet = "\n".join(text.split("\n", 2)[:2])
+    # Collapse whitespace runs and drop control characters: long indents,
+    # \r\n and stray escapes would otherwise reach the model as escaped
+    # JSON noise, billed per token.
+    return " ".join(snippet.split()).translate(_CTRL_TBL)
+
+
+def _preview_file(fp: str) -> str | None:
+    """Produce the preview for one file."""
+    try:
+        # Bounded read: the preview only ever keeps the first two lines, so
+        # never pull more than 2 KiB off disk per file.
+        with open(fp, "rb") as f:
+            buf = f.read(2048)
+        return _truncate_snippet(buf)
+    except Exception:
+        return None
+
+
+def _walk_structure(
+    path: Path, max_file_size: int
+) -> tuple[List[Dict[str, Any]], List[tuple[int, str]]]:
+    """scandir walk shared by the sync and async crawls: returns the entry
+    list plus (index, path) pairs of the files that still need a preview."""
+    structure: List[Dict[str, Any]] = []
+    previews: List[tuple[int, str]] = []
+    # Iterative scandir walk: DirEntry caches the dirent type, so is_dir/is_file
+    # cost no extra stat() the way rglob + Path.is_file() does.
+    stack: List[tuple[str, str]] = [(str(path), "")]
+    while stack:
+        dir_path, prefix = stack.pop()
+        try:
+            it = os.scandir(dir_path)
+        except OSError:
+            continue
+        with it:
+            for e in it:
+                if e.name.startswith(".") or e.name in _SKIP_DIRS:
+                    continue
+                if e.is_dir(follow_symlinks=False):
+                    stack.append((e.path, f"{prefix}{e.name}/"))
+                    continue
+                if not e.is_file(follow_symlinks=False):
+                    continue
+                entry: Dict[str, Any] = {
+                    "path": f"{prefix}{e.name}",
+                    "size": e.stat().st_size,
+                }
+                if (
+                    entry["size"] <= max_file_size
+                    and os.path.splitext(e.name)[1].lower() not in _BINARY_EXTS
+                ):
+                    previews.append((len(structure), e.path))
+                structure.append(entry)
+    return structure, previews
+
+
+@st.cache_resource(show_spinner=False)
+def _crawl_pool() -> ThreadPoolExecutor:
+    """One preview-read pool for the app's lifetime — spinning up a fresh
+    pool per crawl leaked threads across Streamlit reruns."""
+    max_workers = min(32, (os.cpu_count() or 4) * 4)
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="crawl")
+
+
 def crawl_directory(path: Path, max_file_size: int = 10_000) -> List[Dict[str, Any]]:
     """Return a list describing the repository’s files (preview ≤ 5 lines/200 words)."""
 
-    structure: List[Dict[str, Any]] = []
-    for fp in path.rglob("*"):
-        if not fp.is_file():
-            if fp.name == "venv" or fp.name == ".venv":
+    structure, previews = _walk_structure(path, max_file_size)
+    # Preview reads are independent I/O waits (the GIL is released during
+    # file I/O), so overlap them; tiny repos skip the pool dispatch.
+    if len(previews) < 16:
+        for index, fp in previews:
+            structure[index]["content"] = _preview_file(fp)
+    else:
+        paths = [fp for _, fp in previews]
+        for (index, _), content in zip(
+            previews, _crawl_pool().map(_preview_file, paths, chunksize=64)
+        ):
+            structure[index]["content"] = content
+    structure.sort(key=lambda e: e["path"])
+    return structure
+
+
+async def _preview_file_async(fp: str, sem: asyncio.Semaphore) -> str | None:
+    try:
+        async with sem:
+            async with aiofiles.open(fp, "rb") as f:
+                buf = await f.read(2048)
+        return _truncate_snippet(buf)
+    except Exception:
+        return None
+
+
+async def crawl_directory_async(
+    path: Path, max_file_size: int = 10_000
+) -> List[Dict[str, Any]]:
+    """crawl_directory for callers already on the event loop: the preview
+    reads run through aiofiles under a semaphore, so they interleave with
+    other loop work (e.g. an in-flight API call) instead of blocking it."""
+    structure, previews = _walk_structure(path, max_file_size)
+    sem = asyncio.Semaphore(64)
+    contents = await asyncio.gather(
+        *[_preview_file_async(fp, sem) for _, fp in previews]
+    )
+    for (index, _), content in zip(previews, contents):
+        structure[index]["content"] = content
+    structure.sort(key=lambda e: e["path"])
+    return structure
+
+
+def _repo_fingerprint(path: Path) -> tuple:
+    """Cheap change marker for a repo: (name, mtime_ns, size) of its
+    top-level entries from one scandir pass. Not bulletproof against deep
+    edits that leave every top-level mtime untouched, but catches normal
+    workflows at negligible cost."""
+    items = []
+    try:
+        with os.scandir(path) as it:
+            for e in it:
+                try:
+                    s = e.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                items.append((e.name, s.st_mtime_ns, s.st_size))
+    except OSError:
+        pass
+    return tuple(sorted(items))
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _crawl_cached(
+    path_str: str, max_file_size: int, fingerprint: tuple
+) -> List[Dict[str, Any]]:
+    """crawl_directory behind st.cache_data; *fingerprint* keys the cache so
+    an unchanged repo skips the re-walk entirely on reruns."""
+    if aiofiles is not None:
+        return _run_async(crawl_directory_async(Path(path_str), max_file_size))
+    return crawl_directory(Path(path_str), max_file_size)
+
+
+async def _gather_inputs(
+    repo_path: Path, pol_path: Path, max_file_size: int
+) -> tuple[List[Dict[str, Any]], str]:
+    """Crawl the repo and read the policy concurrently (both are I/O-bound)."""
+    crawl_task = asyncio.create_task(
+        asyncio.to_thread(
+            _crawl_cached, str(repo_path), max_file_size, _repo_fingerprint(repo_path)
+        )
+    )
+    policy = await asyncio.to_thread(
+        _read_policy, str(pol_path), pol_path.stat().st_mtime_ns
+    )
+    return await crawl_task, policy
+
+
+def _run_with_progress(label: str, fn, *args):
+    """Run *fn* on a worker thread while animating a progress bar.
+
+    A long blocking call on the script thread freezes the page — progress
+    jumps would only paint after the call returns. Polling the future lets
+    the bar actually move during extraction and crawling.
+    """
+    progress = st.progress(0, text=label)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(fn, *args)
+        pct = 0
+        while not future.done():
+            pct = min(pct + 1, 90)
+            progress.progress(pct, text=label)
+            time.sleep(0.1)
+    progress.empty()
+    return future.result()
+
+
+def summarize_tree(files: List[str], max_files_per_dir: int = 10) -> str:
+    """Compress a flat path list into a compact per-directory summary.
+
+    Lists at most *max_files_per_dir* names per directory, collapses
+    directories with uniform extensions to ``src/ (47 .py files)``, and caps
+    the whole summary at ~4000 chars — enough resolution for a structure
+    review at a fraction of the tokens.
+    """
+    by_dir: Dict[str, List[str]] = {}
+    for f in files:
+        d, _, name = f.rpartition("/")
+        by_dir.setdefault(d, []).append(name)
+    lines: List[str] = []
+    for d in sorted(by_dir):
+        names = by_dir[d]
+        label = f"{d}/" if d else "./"
+        suffixes = {os.path.splitext(n)[1] for n in names}
+        if len(names) > max_files_per_dir and len(suffixes) == 1:
+            lines.append(f"{label} ({len(names)} {suffixes.pop() or 'extensionless'} files)")
+            continue
+        lines.append(label)
+        lines.extend(f"  {n}" for n in names[:max_files_per_dir])
+        if len(names) > max_files_per_dir:
+            lines.append(f"  ... and {len(names) - max_files_per_dir} more")
+    return "\n".join(lines)[:4000]
+
+
+# Above this many files the full JSON structure blows the token budget;
+# fall back to the summarized tree.
+_SUMMARIZE_THRESHOLD = 500
+
+
+def extract_zip(uploaded_file, extract_to: Path) -> None:
+    """Stream an uploaded zip into *extract_to* one entry at a time.
+
+    Avoids ``ZipFile.extractall`` so peak memory stays bounded (1 MiB copy
+    window) even for very large archives, and skips entries whose resolved
+    path would escape *extract_to* (zip-slip).
+    """
+    root = extract_to.resolve()
+    with zipfile.ZipFile(uploaded_file) as zip_ref:
+        for info in zip_ref.infolist():
+            target = (extract_to / info.filename).resolve()
+            if not target.is_relative_to(root):
+                continue  # zip-slip guard
+            if info.is_dir():
+                target.mkdir(parents=True, exist_ok=True)
                 continue
-        if fp.is_file():
-            entry: Dict[str, Any] = {
-                "path": str(fp.relative_to(path)),
-                "size": fp.stat().st_size,
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with zip_ref.open(info) as src, open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst, length=1 << 20)
+
+
+@st.cache_resource(show_spinner=False)
+def _get_openai_client(api_key_hash: str, _api_key: str):
+    """One shared OpenAI client per key. Rebuilding the client per call
+    re-created an httpx pool + TLS context each time; caching it as a
+    resource keeps the connection to api.openai.com warm across reruns.
+    Only the key's SHA-256 enters the cache key (underscore arg)."""
+    return _openai_cls()(api_key=_api_key)
+
+
+@st.cache_data(show_spinner=False)
+def _read_policy(policy_path: str, mtime_ns: int) -> str:
+    """Cached policy read; *mtime_ns* keys the cache so edits invalidate it."""
+    return Path(policy_path).read_text(encoding="utf-8", errors="ignore")
+
+
+def _structure_payload(
+    structure: List[Dict[str, Any]], include_previews: bool = True
+) -> str:
+    """Serialize the crawled structure for the prompt, summarizing past the
+    token-budget threshold. Compact separators: the model doesn't need
+    pretty-printing and the whitespace would be billed as tokens. With
+    *include_previews* off only paths and sizes are shipped — usually all a
+    structure review needs, at a fraction of the tokens."""
+    if len(structure) > _SUMMARIZE_THRESHOLD:
+        return summarize_tree([e["path"] for e in structure])
+    if not include_previews:
+        structure = [{"path": e["path"], "size": e["size"]} for e in structure]
+    return json.dumps(structure, ensure_ascii=False, separators=(",", ":"))
+
+
+@st.cache_data(show_spinner=False, max_entries=256, persist="disk")
+def _llm_report(
+    policy: str,
+    structure_json: str,
+    model: str,
+    temperature: float,
+    _api_key: str,
+    _placeholder=None,
+) -> str:
+    """Build the prompt and ask the model; memoized on everything that
+    determines the answer. The answer does not depend on the key, so the key
+    stays out of the cache entirely (underscore arg). When *_placeholder* is
+    given, partial output is rendered into it as tokens arrive."""
+    api_key_hash = hashlib.sha256(_api_key.encode()).hexdigest()
+    client = _get_openai_client(api_key_hash, _api_key=_api_key)
+    user_prompt = (
+        f"Policy:\n{policy}\n\nFolder Structure and Files:\n{structure_json}\n"
+    )
+    for attempt in range(3):
+        try:
+            stream = client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": _SYSTEM_PROMPT},
+                    {"role": "user", "content": user_prompt},
+                ],
+                temperature=temperature,
+                stream=True,
+            )
+            parts: List[str] = []
+            for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    # throttle UI updates so the WebSocket isn't flooded
+                    if _placeholder is not None and len(parts) % 25 == 0:
+                        _placeholder.markdown("".join(parts))
+            break
+        except Exception:
+            if attempt == 2:
+                raise
+            time.sleep(2**attempt)  # 1s, 2s — rides out transient 429/5xx
+    return "".join(parts)
+
+
+# Tool offered in deep mode so the model can pull previews on demand.
+_PREVIEW_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "request_file_previews",
+        "description": (
+            "Request first-lines previews of specific files before giving "
+            "the final report."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "paths": {"type": "array", "items": {"type": "string"}}
+            },
+            "required": ["paths"],
+        },
+    },
+}
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _llm_report_deep(
+    policy: str,
+    structure_json: str,
+    model: str,
+    temperature: float,
+    _api_key: str,
+    _previews: Dict[str, str],
+) -> str:
+    """Two-pass review: the first call sees only paths + sizes and may ask
+    for specific previews via the request_file_previews tool; the second
+    call answers with just those previews attached. Keeps input tokens
+    proportional to what the model actually wants to inspect."""
+    client = _get_openai_client(
+        hashlib.sha256(_api_key.encode()).hexdigest(), _api_key=_api_key
+    )
+    messages: List[Any] = [
+        {"role": "system", "content": _SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": (
+                f"Policy:\n{policy}\n\nFolder Structure and Files:\n"
+                f"{structure_json}\n"
+            ),
+        },
+    ]
+    response = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        tools=[_PREVIEW_TOOL],
+    )
+    msg = response.choices[0].message
+    if not msg.tool_calls:
+        return msg.content
+    messages.append(msg)
+    for call in msg.tool_calls:
+        try:
+            paths = json.loads(call.function.arguments).get("paths", [])[:50]
+        except Exception:
+            paths = []
+        messages.append(
+            {
+                "role": "tool",
+                "tool_call_id": call.id,
+                "content": json.dumps(
+                    {p: _previews.get(p) for p in paths}, ensure_ascii=False
+                ),
             }
-            if entry["size"] <= max_file_size:
-                try:
-                    text = fp.read_text(errors="ignore")
-                    snippet = "\n".join(text.splitlines()[:2])
-                    words = snippet.split()
-                    if len(words) > 100:
-                        snippet = " ".join(words[:200])
-                    entry["content"] = snippet
-                except Exception:
-                    entry["content"] = None
-            structure.append(entry)
-    return structure
+        )
+    final = client.chat.completions.create(
+        model=model, messages=messages, temperature=temperature
+    )
+    return final.choices[0].message.content
 
 
 def ask_chatgpt(
@@ -92,26 +530,148 @@ def ask_chatgpt(
     api_key: str,
     model: str = "gpt-4o",
     temperature: float = 0.2,
+    placeholder=None,
+    structure_json: str | None = None,
+    deep: bool = False,
 ) -> str:
-    client = OpenAI(api_key=api_key)
-    system_prompt = (
-        """
-You are an expert project steward whose job is to keep every code or data repository in a clean, transparent, and reproducible state. Whenever a user asks you to create, rename, reorganise, or review files and folders, apply the following policy strictly and proactively. Never apologise for enforcing these rules—simply explain the required change and show the corrected structure.
-        """
-    ).strip()
-    user_prompt = (
-        f"Policy:\n{policy}\n\nFolder Structure and Files:\n"
-        f"{json.dumps(structure, indent=2, ensure_ascii=False)}\n"
+    if deep:
+        previews = {
+            e["path"]: e["content"] for e in structure if e.get("content")
+        }
+        slim = _structure_payload(structure, include_previews=False)
+        return _llm_report_deep(
+            policy, slim, model, temperature, _api_key=api_key, _previews=previews
+        )
+    # Callers that crawled via the UI pass the payload pre-serialized so
+    # reruns don't re-dump thousands of entries before the cache lookup.
+    if structure_json is None:
+        structure_json = _structure_payload(structure)
+    return _llm_report(
+        policy,
+        structure_json,
+        model,
+        temperature,
+        _api_key=api_key,
+        _placeholder=placeholder,
     )
-    response = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        temperature=temperature,
+
+
+async def run_validations_async(
+    jobs: List[Dict[str, Any]],
+    policy: str,
+    api_key: str,
+    model: str = "gpt-4o",
+    temperature: float = 0.2,
+    max_concurrency: int = 8,
+    deep: bool = False,
+) -> List[Dict[str, Any]]:
+    """Validate several crawled repositories against *policy* concurrently.
+
+    Wall time is network-bound on the LLM API, so the calls are interleaved
+    under a semaphore that keeps us below the provider's rate limit.
+    """
+    sem = asyncio.Semaphore(max_concurrency)
+
+    async def _one(job: Dict[str, Any]) -> Dict[str, Any]:
+        async with sem:
+            report = await asyncio.to_thread(
+                lambda: ask_chatgpt(
+                    job["structure"],
+                    policy,
+                    api_key,
+                    model,
+                    temperature,
+                    structure_json=job.get("payload"),
+                    deep=deep,
+                )
+            )
+        return {**job, "report": report}
+
+    return list(await asyncio.gather(*[_one(j) for j in jobs]))
+
+
+def _submit_batch(
+    jobs: List[Dict[str, Any]],
+    policy: str,
+    api_key: str,
+    model: str,
+    temperature: float,
+) -> tuple[str, Dict[str, str]]:
+    """Submit the validations through the OpenAI Batch API.
+
+    Serializes one chat request per repository as JSONL, uploads it via the
+    Files API, and opens a 24h batch job — half-price tokens and higher rate
+    limits, at the cost of interactive latency. Returns the batch id plus a
+    custom_id → repo-name map for rendering the results later.
+    """
+    client = _get_openai_client(
+        hashlib.sha256(api_key.encode()).hexdigest(), _api_key=api_key
     )
-    return response.choices[0].message.content
+    names: Dict[str, str] = {}
+    lines: List[str] = []
+    for job in jobs:
+        custom_id = f"steward-{uuid.uuid4().hex[:12]}"
+        names[custom_id] = job["name"]
+        payload = job.get("payload") or _structure_payload(job["structure"])
+        user_prompt = (
+            f"Policy:\n{policy}\n\nFolder Structure and Files:\n{payload}\n"
+        )
+        body = {
+            "model": model,
+            "temperature": temperature,
+            "messages": [
+                {"role": "system", "content": _SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt},
+            ],
+        }
+        lines.append(
+            json.dumps(
+                {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": body,
+                },
+                ensure_ascii=False,
+            )
+        )
+    payload = io.BytesIO("\n".join(lines).encode("utf-8"))
+    input_file = client.files.create(
+        file=("steward_batch.jsonl", payload), purpose="batch"
+    )
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    return batch.id, names
+
+
+def _render_batch_output(api_key: str) -> None:
+    """Poll the pending batch job and render its reports once completed."""
+    client = _get_openai_client(
+        hashlib.sha256(api_key.encode()).hexdigest(), _api_key=api_key
+    )
+    batch = client.batches.retrieve(st.session_state["batch_id"])
+    if batch.status != "completed":
+        st.info(f"Batch `{batch.id}`: **{batch.status}**")
+        if st.button("Refresh status"):
+            st.rerun()
+        return
+    raw = client.files.content(batch.output_file_id).text
+    names = st.session_state.get("batch_names", {})
+    for line in raw.splitlines():
+        item = json.loads(line)
+        name = names.get(item["custom_id"], item["custom_id"])
+        report = item["response"]["body"]["choices"][0]["message"]["content"]
+        with st.expander(name, expanded=True):
+            st.markdown(_md_to_details(report), unsafe_allow_html=True)
+            st.download_button(
+                "Download Markdown",
+                report,
+                f"steward_{name}.md",
+                key=f"batch_download_{name}",
+            )
 
 
 # ────────────────────────────────────────────────────────────────────────────────
@@ -123,39 +683,54 @@ try:
 except ImportError:
     _mdlib = None
 
+# One converter for the module: building it re-registers extensions and
+# recompiles their regexes, so do that once instead of per call.
+_MD = _mdlib.Markdown(extensions=["fenced_code", "tables"]) if _mdlib else None
+
+
+_HEADER_RE = re.compile(r"^(#{1,6})\s+(.*)$")
+_FENCE_RE = re.compile(r"^\s*```")
 
+
+@st.cache_data(show_spinner=False, max_entries=8)
 def _md_to_details(md: str) -> str:
-    lines = md.splitlines()
-    html: List[str] = []
+    # Write straight into a StringIO: no list of line objects to grow and
+    # no second pass for a final join.
+    buf = io.StringIO()
     stack: List[int] = []
     in_code = False
 
     def close(to: int | None = None):
         while stack and (to is None or stack[-1] >= to):
-            html.append("</details>")
+            buf.write("</details>\n")
             stack.pop()
 
-    for line in lines:
-        if line.strip().startswith("```"):
+    # Iterate the source in place instead of materializing splitlines();
+    # keeps peak memory at ~1x the input for multi-MB answers.
+    for line in io.StringIO(md):
+        line = line.rstrip("\n")
+        if _FENCE_RE.match(line):
             in_code = not in_code
-            html.append(line)
+            buf.write(line)
+            buf.write("\n")
             continue
         if not in_code:
-            m = re.match(r"^(#{1,6})\s+(.*)$", line)
+            m = _HEADER_RE.match(line)
             if m:
                 level = len(m.group(1))
                 title = m.group(2)
                 close(level)
-                html.append(
-                    f"<details><summary><h{level} style='display:inline'>{title}</h{level}></summary>"
+                buf.write(
+                    f"<details><summary><h{level} style='display:inline'>{title}</h{level}></summary>\n"
                 )
                 stack.append(level)
                 continue
-        html.append(line)
+        buf.write(line)
+        buf.write("\n")
     close()
-    joined = "\n".join(html)
-    if _mdlib is not None:
-        return _mdlib.markdown(joined, extensions=["fenced_code", "tables"])
+    joined = buf.getvalue()
+    if _MD is not None:
+        return _MD.reset().convert(joined)
     return joined
 
 
@@ -164,6 +739,7 @@ def _md_to_details(md: str) -> str:
 # ────────────────────────────────────────────────────────────────────────────────
 
 def run_web_ui():
+    _prewarm_imports()
     st.set_page_config(page_title="Repository Steward", layout="wide")
     st.title("🗂️ Repository Steward")
 
@@ -180,6 +756,21 @@ def run_web_ui():
     )
     model_name = st.sidebar.text_input("Model", value="gpt-4o")
     temperature = st.sidebar.slider("Temperature", 0.0, 1.0, 0.2, 0.05)
+    batch_mode = st.sidebar.checkbox(
+        "Batch mode (50% cost, up to 24h)",
+        help="Submits via the OpenAI Batch API instead of answering live.",
+    )
+    include_previews = st.sidebar.checkbox(
+        "Include file previews",
+        value=False,
+        help="Ship first-lines previews with every file (more tokens).",
+    )
+    deep_mode = st.sidebar.checkbox(
+        "Deep mode (2-pass)",
+        value=False,
+        help="The model sees paths + sizes first and may request previews "
+        "for specific files in a second pass.",
+    )
 
     repo_root_key = "repo_root_path"
     if repo_root_key not in st.session_state:
@@ -212,6 +803,13 @@ def run_web_ui():
         )
         st.session_state[repo_root_key] = typed
 
+    uploaded_zips = st.sidebar.file_uploader(
+        "…or upload repositories as .zip",
+        type="zip",
+        accept_multiple_files=True,
+        help="Extracted to temporary folders; overrides the path above.",
+    )
+
     # Policy path – default inside repo ------------------------------------
     def _default_policy_path() -> str:
         root = Path(st.session_state[repo_root_key])
@@ -226,12 +824,20 @@ def run_web_ui():
     with col_in:
         st.header("1️⃣ Input")
         if st.button("Analyse repository", use_container_width=True):
-            repo_path = Path(st.session_state[repo_root_key]).expanduser()
+            repos: List[tuple[str, Path]] = []
+            if uploaded_zips:
+                for up in uploaded_zips:
+                    dest = Path(tempfile.mkdtemp(prefix="data_police_"))
+                    _run_with_progress(f"Extracting {up.name}…", extract_zip, up, dest)
+                    repos.append((up.name, dest))
+            else:
+                repo_path = Path(st.session_state[repo_root_key]).expanduser()
+                if not repo_path.exists():
+                    st.error("Repository folder not found: %s" % repo_path)
+                    st.stop()
+                repos.append((repo_path.name or str(repo_path), repo_path))
             pol_path = Path(policy_path_input).expanduser()
 
-            if not repo_path.exists():
-                st.error("Repository folder not found: %s" % repo_path)
-                st.stop()
             if not pol_path.exists():
                 st.error("Policy file not found: %s" % pol_path)
                 st.stop()
@@ -239,24 +845,104 @@ def run_web_ui():
                 st.error("OpenAI API key is missing.")
                 st.stop()
 
-            with st.status("Crawling repository…", expanded=False):
-                structure = crawl_directory(repo_path, max_file_size)
-            st.session_state.update(structure=structure, policy=pol_path.read_text())
-            st.success("Repository crawled – view output on the right.")
+            jobs: List[Dict[str, Any]] = []
+            for name, rp in repos:
+                structure, policy = _run_with_progress(
+                    f"Crawling {name}…",
+                    _run_async,
+                    _gather_inputs(rp, pol_path, max_file_size),
+                )
+                jobs.append(
+                    {
+                        "name": name,
+                        "structure": structure,
+                        # serialize once here, not on every rerun
+                        "payload": _structure_payload(structure, include_previews),
+                    }
+                )
+            if batch_mode:
+                batch_id, batch_names = _submit_batch(
+                    jobs, policy, api_key, model_name, temperature
+                )
+                st.session_state.pop("jobs", None)
+                st.session_state.update(batch_id=batch_id, batch_names=batch_names)
+                st.success("Batch submitted – poll its status on the right.")
+            else:
+                st.session_state.pop("batch_id", None)
+                st.session_state.pop("results", None)  # stale for new crawl
+                st.session_state.update(jobs=jobs, policy=policy)
+                st.success("Repositories crawled – view output on the right.")
+
+        # One st.code block per repo: a single ForwardMsg to the browser
+        # instead of one st.text round-trip per file.
+        for job in st.session_state.get("jobs", []):
+            with st.expander(f"Crawled files – {job['name']}"):
+                st.code(
+                    "\n".join(e["path"] for e in job["structure"]), language=None
+                )
 
     with col_out:
         st.header("2️⃣ Output")
-        if "structure" in st.session_state:
-            with st.spinner("ChatGPT thinking…"):
-                md_answer = ask_chatgpt(
-                    st.session_state["structure"],
-                    st.session_state["policy"],
-                    api_key,
-                    model_name,
-                    temperature,
+        if "batch_id" in st.session_state:
+            _render_batch_output(api_key)
+        elif "jobs" in st.session_state:
+            jobs = st.session_state["jobs"]
+            # Explicit gate: without it, every rerun from an unrelated
+            # widget (slider, text input) re-entered the validation path.
+            with st.form("run_form"):
+                submit = st.form_submit_button(
+                    "Ask ChatGPT", use_container_width=True
                 )
-            st.markdown(_md_to_details(md_answer), unsafe_allow_html=True)
-            st.download_button("Download Markdown", md_answer, "steward_answer.md")
+            if submit:
+                if len(jobs) == 1 and deep_mode:
+                    with st.spinner("ChatGPT thinking (2-pass)…"):
+                        report = ask_chatgpt(
+                            jobs[0]["structure"],
+                            st.session_state["policy"],
+                            api_key,
+                            model_name,
+                            temperature,
+                            deep=True,
+                        )
+                    results = [{**jobs[0], "report": report}]
+                elif len(jobs) == 1:
+                    # Single repo: stream tokens into the page as they arrive
+                    # instead of hiding the whole generation behind a spinner.
+                    placeholder = st.empty()
+                    report = ask_chatgpt(
+                        jobs[0]["structure"],
+                        st.session_state["policy"],
+                        api_key,
+                        model_name,
+                        temperature,
+                        placeholder=placeholder,
+                        structure_json=jobs[0].get("payload"),
+                    )
+                    placeholder.empty()
+                    results = [{**jobs[0], "report": report}]
+                else:
+                    with st.spinner("ChatGPT thinking…"):
+                        results = _run_async(
+                            run_validations_async(
+                                jobs,
+                                st.session_state["policy"],
+                                api_key,
+                                model_name,
+                                temperature,
+                                deep=deep_mode,
+                            )
+                        )
+                st.session_state["results"] = results
+            results = st.session_state.get("results", [])
+            for res in results:
+                with st.expander(res["name"], expanded=len(results) == 1):
+                    st.markdown(_md_to_details(res["report"]), unsafe_allow_html=True)
+                    st.download_button(
+                        "Download Markdown",
+                        res["report"],
+                        f"steward_{res['name']}.md",
+                        key=f"download_{res['name']}",
+                    )
 
 
 # ────────────────────────────────────────────────────────────────────────────────
@@ -276,5 +962,10 @@ if __name__ == "__main__":
     if _running_inside_streamlit():
         run_web_ui()
     else:
-        subprocess.run(["streamlit", "run", sys.argv[0], *sys.argv[1:]], check=False)
+        # In-process relaunch: no second interpreter to fork+exec and
+        # re-import streamlit in, and the exit code propagates.
+        from streamlit.web import cli as stcli
+
+        sys.argv = ["streamlit", "run", sys.argv[0], *sys.argv[1:]]
+        sys.exit(stcli.main())
 